@@ -1,66 +1,278 @@
-from typing import TypeVar
+import re
+import sys
+from functools import lru_cache
+from types import MappingProxyType, SimpleNamespace
+from typing import Iterable, TypeVar
+
+# TODO: tighten once the final fcode format is specified
+_CODE_RE = re.compile(r"[A-Za-z_][A-Za-z0-9_.:-]*")
+
+# how many registry mutations are allowed before stale _issub entries are
+# dropped wholesale
+_ISSUB_CLEAR_PERIOD = 1024
+
+@lru_cache(maxsize=4096)
+def _issub(t: type, base: type, version: int) -> bool:
+    # version keys the cache to the registry state, so entries memoized
+    # before a defcode/undefcode are never served after it
+    return issubclass(t, base)
 
 class FcodeCore:
-    _active_code_to_type: dict[str, type] = {}
-    _legacy_code_to_type: dict[str, type] = {}
-    _non_decorator_codes: list[str] = []
+    # code -> (type, is_active); a single map so any-code lookups cost one
+    # probe instead of two
+    _code_to_type: dict[str, tuple[type, bool]] = {}
+    _type_to_active_code: dict[type, str] = {}
+    _type_to_legacy_codes: dict[type, list[str]] = {}
+    _non_decorator_codes: set[str] = set()
+    _pending_decorator_codes: list[tuple[str, type, list[str] | None]] = []
+    # codes and types already queued, for decoration-time conflict checks
+    _pending_decorator_codeset: set[str] = set()
+    _pending_decorator_types: set[type] = set()
+    _version = 0
+    _frozen: SimpleNamespace | None = None
     deflock = False
 
+    @classmethod
+    def _get_frozen(cls) -> SimpleNamespace | None:
+        """
+        Returns read-only snapshots of the lookup tables while deflock is
+        set, building them on first locked read.
+
+        Since deflock is a plain attribute there is no setter to hook, so
+        the snapshot is also dropped lazily here once the lock is lifted.
+        """
+        if not cls.deflock:
+            cls._frozen = None
+            return None
+        frozen = cls._frozen
+        if frozen is None:
+            frozen = cls._frozen = SimpleNamespace(
+                code_to_type=MappingProxyType(dict(cls._code_to_type)),
+                type_to_active_code=MappingProxyType(
+                    dict(cls._type_to_active_code),
+                ),
+                type_to_legacy_codes=MappingProxyType({
+                    t: tuple(lcs)
+                    for t, lcs in cls._type_to_legacy_codes.items()
+                }),
+            )
+        return frozen
+
+    @classmethod
+    def _bump_version(cls):
+        cls._version += 1
+        # a mutation after unlocking must not leave a snapshot that a
+        # later re-lock would serve
+        cls._frozen = None
+        if cls._version % _ISSUB_CLEAR_PERIOD == 0:
+            _issub.cache_clear()
+
     @classmethod
     def defcode(
         cls,
         code: str,
         t: type,
         legacy_codes: list[str] | None = None,
-        *,
-        _is_from_decorator: bool = False
     ) -> None:
+        cls._flush_pending_decorator_codes()
         if cls.deflock:
             raise ValueError("deflock")
+        cls._defcode(code, t, legacy_codes, False)
 
-        cls.check_code_valid(code)
+    @classmethod
+    def _flush_pending_decorator_codes(cls) -> None:
+        """
+        Registers everything queued by the code decorator in one batch.
 
-        legacy_codes_to_attach: list[str] = []
+        Called on entry to every registry API, so decorator registration
+        is deferred from import to first use and amortized through
+        _defcodes. The queue only fills while unlocked (the decorator
+        raises under deflock), so flushing deliberately bypasses the
+        deflock check: classes decorated before locking stay readable
+        after it.
+        """
+        pending = cls._pending_decorator_codes
+        if not pending:
+            return
+        entries = tuple(pending)
+        pending.clear()
+        cls._pending_decorator_codeset.clear()
+        cls._pending_decorator_types.clear()
+        try:
+            cls._defcodes(entries, True)
+        except ValueError:
+            # decoration-time checks make a failing batch unreachable in
+            # normal use; if one still fails, commit the valid entries
+            # and surface the bad ones once instead of re-queueing them
+            # on every registry access
+            errs: list[str] = []
+            for pcode, t, legacy_codes in entries:
+                try:
+                    cls._defcode(pcode, t, legacy_codes, True)
+                except ValueError as err:
+                    errs.append(str(err))
+            if errs:
+                raise ValueError("; ".join(errs)) from None
 
-        if code in cls._active_code_to_type:
+    @classmethod
+    def _defcode(
+        cls,
+        code: str,
+        t: type,
+        legacy_codes: list[str] | None,
+        is_from_decorator: bool,
+    ) -> None:
+        # the deflock check lives in the public entry points: the
+        # decorator queue is only filled while unlocked and must still be
+        # flushable after locking
+        # interned keys let later dict probes hit the identity fast-path
+        # instead of hashing and comparing the full string
+        code = sys.intern(code)
+        code_to_type = cls._code_to_type
+        # reject duplicates before the pricier regex validation
+        if code in code_to_type:
             raise ValueError(
-                f"active code {code} already registered",
+                f"code {code} already registered",
             )
+        # a second active code would silently overwrite the reverse index
+        # and leave the first code half-mapped
+        if t in cls._type_to_active_code:
+            raise ValueError(
+                f"type {t} already registered under active code"
+                f" {cls._type_to_active_code[t]}",
+            )
+        cls.check_code_valid(code)
 
         if legacy_codes:
+            # validate everything before writing anything, so a rejected
+            # legacy code cannot leak its predecessors into the registry;
+            # the staging list only exists when there are legacy codes
+            legacy_codes_to_attach: list[str] = []
             for lc in legacy_codes:
+                lc = sys.intern(lc)
                 cls.check_code_valid(lc)
 
-                if lc in cls._legacy_code_to_type:
+                if (
+                    lc in code_to_type
+                    or lc in legacy_codes_to_attach
+                    or lc == code
+                ):
                     raise ValueError(
-                        f"legacy code {lc} already registered",
+                        f"code {lc} already registered",
                     )
                 legacy_codes_to_attach.append(lc)
 
-        for lc in legacy_codes_to_attach:
-            cls._legacy_code_to_type[lc] = t
-        cls._active_code_to_type[code] = t
+            for lc in legacy_codes_to_attach:
+                code_to_type[lc] = (t, False)
+                cls._type_to_legacy_codes.setdefault(t, []).append(lc)
+
+        code_to_type[code] = (t, True)
+        cls._type_to_active_code[t] = code
+        cls._bump_version()
+
+        if not is_from_decorator:
+            cls._non_decorator_codes.add(code)
+
+    @classmethod
+    def defcodes(
+        cls,
+        entries: Iterable[tuple[str, type, list[str] | None]],
+    ) -> None:
+        """
+        Registers many codes at once.
+
+        All entries are validated before anything is written, so either
+        every entry lands or none does; the actual writes are bulk dict
+        updates instead of per-code assignments.
+        """
+        cls._flush_pending_decorator_codes()
+        if cls.deflock:
+            raise ValueError("deflock")
+        cls._defcodes(entries, False)
+
+    @classmethod
+    def _defcodes(
+        cls,
+        entries: Iterable[tuple[str, type, list[str] | None]],
+        is_from_decorator: bool,
+    ) -> None:
+        code_to_type = cls._code_to_type
+        adds: dict[str, tuple[type, bool]] = {}
+        active_adds: dict[type, str] = {}
+        legacy_adds: dict[type, list[str]] = {}
+
+        for code, t, legacy_codes in entries:
+            code = sys.intern(code)
+            cls.check_code_valid(code)
+            if code in code_to_type or code in adds:
+                raise ValueError(
+                    f"code {code} already registered",
+                )
+            if t in cls._type_to_active_code or t in active_adds:
+                raise ValueError(
+                    f"type {t} already registered under an active code",
+                )
+            adds[code] = (t, True)
+            active_adds[t] = code
 
-        if not _is_from_decorator:
-            cls._non_decorator_codes.append(code)
+            if legacy_codes:
+                for lc in legacy_codes:
+                    lc = sys.intern(lc)
+                    cls.check_code_valid(lc)
+                    if lc in code_to_type or lc in adds:
+                        raise ValueError(
+                            f"code {lc} already registered",
+                        )
+                    adds[lc] = (t, False)
+                    legacy_adds.setdefault(t, []).append(lc)
+
+        code_to_type.update(adds)
+        cls._type_to_active_code.update(active_adds)
+        for t, lcs in legacy_adds.items():
+            cls._type_to_legacy_codes.setdefault(t, []).extend(lcs)
+        if not is_from_decorator:
+            cls._non_decorator_codes.update(active_adds.values())
+        cls._bump_version()
 
     @classmethod
-    def clean_non_decorator_codes(cls):
-        for c in cls._non_decorator_codes:
-            cls.try_undefcode(c)
+    def clean_non_decorator_codes(cls) -> bool:
+        """
+        Undefines all non-decorator codes.
+
+        Codes that cannot be undefined (e.g. under deflock) are kept for
+        the next call, so every pass commits whatever progress it made.
+        Returns whether everything was cleaned.
+        """
+        cls._flush_pending_decorator_codes()
+        remaining: set[str] = set()
+        # snapshot so try_undefcode is free to touch the set
+        for c in tuple(cls._non_decorator_codes):
+            if not cls.try_undefcode(c):
+                remaining.add(c)
+        cls._non_decorator_codes = remaining
+        return not remaining
 
     @classmethod
     def try_undefcode(cls, code: str):
         if cls.deflock:
             return False
-        if code in cls._active_code_to_type:
-            del cls._active_code_to_type[code]
-            return True
-        if code in cls._legacy_code_to_type:
-            del cls._legacy_code_to_type[code]
-            return True
+        cls._flush_pending_decorator_codes()
+        entry = cls._code_to_type.pop(code, None)
+        if entry is None:
+            return False
 
-        return False
+        t, is_active = entry
+        if is_active:
+            # each type holds exactly one active code, enforced in _defcode
+            del cls._type_to_active_code[t]
+        else:
+            lcs = cls._type_to_legacy_codes.get(t)
+            if lcs is not None:
+                lcs.remove(code)
+                if not lcs:
+                    del cls._type_to_legacy_codes[t]
+        cls._bump_version()
+        return True
 
     @classmethod
     def try_get_all_codes(
@@ -71,13 +283,29 @@ class FcodeCore:
         Returns list of code collections, where first code in a collection
         is always an active one.
         """
-        res = []
-        for v in cls._active_code_to_type.values():
-            if (
-                where_base_type is None
-                or issubclass(v, where_base_type)
-            ):
-                res.append(cls.get_all_codes_for_type(v))
+        cls._flush_pending_decorator_codes()
+        frozen = cls._get_frozen()
+        if frozen is not None:
+            type_to_active = frozen.type_to_active_code
+            type_to_legacy = frozen.type_to_legacy_codes
+        else:
+            type_to_active = cls._type_to_active_code
+            type_to_legacy = cls._type_to_legacy_codes
+
+        # locals instead of per-iteration attribute loads; splitting the
+        # branch also drops the None check from the loop
+        res: list[list[str]] = []
+        append = res.append
+        get_legacy = type_to_legacy.get
+        if where_base_type is None:
+            for t, active in type_to_active.items():
+                append([active, *get_legacy(t, ())])
+        else:
+            issub = _issub
+            version = cls._version
+            for t, active in type_to_active.items():
+                if issub(t, where_base_type, version):
+                    append([active, *get_legacy(t, ())])
 
         return res
 
@@ -86,10 +314,11 @@ class FcodeCore:
         cls,
         t: type
     ) -> str | None:
-        for k, v in cls._active_code_to_type.items():
-            if v is t:
-                return k
-        return None
+        cls._flush_pending_decorator_codes()
+        frozen = cls._get_frozen()
+        if frozen is not None:
+            return frozen.type_to_active_code.get(t)
+        return cls._type_to_active_code.get(t)
 
     @classmethod
     def get_active_code_for_type(
@@ -113,46 +342,59 @@ class FcodeCore:
 
         First code in the collection is always an active one.
         """
-        res: list[str] = []
+        cls._flush_pending_decorator_codes()
+        frozen = cls._get_frozen()
+        if frozen is not None:
+            type_to_active = frozen.type_to_active_code
+            type_to_legacy = frozen.type_to_legacy_codes
+        else:
+            type_to_active = cls._type_to_active_code
+            type_to_legacy = cls._type_to_legacy_codes
 
-        for k, v in cls._active_code_to_type.items():
-            if v is t:
-                res.append(k)
-                break
+        active = type_to_active.get(t)
 
         # the result cannot be empty, but can contain no legacy codes
-        if not res:
+        if active is None:
             raise ValueError(f"no active codes for {t}")
 
-        for k, v in cls._legacy_code_to_type.items():
-            if v is t:
-                res.append(k)
-
-        return res
+        legacy = type_to_legacy.get(t)
+        if not legacy:
+            return [active]
+        return [active, *legacy]
 
     @classmethod
     def get_type_for_any_code(
         cls,
         code: str,
     ) -> type:
-        res = cls._active_code_to_type.get(code, None)
-        if res is None:
-            res = cls._legacy_code_to_type.get(code, None)
-        if res is None:
-            raise ValueError(f"type not found for any code {code}")
-        return res
+        # lookup codes are usually repeats of registered ones; interning a
+        # plain str makes the probe a pointer compare
+        if type(code) is str:
+            code = sys.intern(code)
+        cls._flush_pending_decorator_codes()
+        frozen = cls._get_frozen()
+        code_to_type = (
+            frozen.code_to_type if frozen is not None else cls._code_to_type
+        )
+        try:
+            return code_to_type[code][0]
+        except KeyError:
+            raise ValueError(
+                f"type not found for any code {code}",
+            ) from None
 
     @classmethod
     def try_get_type_for_any_code(
         cls,
         code: str,
     ) -> type | None:
-        res = cls._active_code_to_type.get(code, None)
-        if res is None:
-            res = cls._legacy_code_to_type.get(code, None)
-        if res is None:
-            return None
-        return res
+        cls._flush_pending_decorator_codes()
+        frozen = cls._get_frozen()
+        code_to_type = (
+            frozen.code_to_type if frozen is not None else cls._code_to_type
+        )
+        entry = code_to_type.get(code)
+        return entry[0] if entry is not None else None
 
     @classmethod
     def check_code_valid(cls, code: str) -> None:
@@ -161,15 +403,60 @@ class FcodeCore:
 
     @classmethod
     def is_code_valid(cls, code: str) -> bool:
-        # TODO: implement fcode format
-        return True
+        return _CODE_RE.fullmatch(code) is not None
 
 TType = TypeVar("TType", bound=type)
 def code(code: str, legacy_codes: list[str] | None = None):
+    # bound once per decoration instead of resolved on every inner call;
+    # all of these keep their identity across flushes
+    core = FcodeCore
+    code_to_type = core._code_to_type
+    codeset = core._pending_decorator_codeset
+    append_pending = core._pending_decorator_codes.append
+
     def inner(target: TType) -> TType:
-        # here fcode sv might be first-time created, so it shouldn't accept
-        # any args
-        FcodeCore.defcode(code, target, legacy_codes, _is_from_decorator=True)
+        # decorating under deflock fails at import, as direct defcode
+        # always did; this also guarantees the queue only holds pre-lock
+        # entries, which lets the flush run under the lock
+        if core.deflock:
+            raise ValueError("deflock")
+        # a bad decoration fails at its own import instead of poisoning
+        # the queued batch for every later registry access
+        core.check_code_valid(code)
+        if code in code_to_type or code in codeset:
+            raise ValueError(
+                f"code {code} already registered",
+            )
+        if (
+            target in core._type_to_active_code
+            or target in core._pending_decorator_types
+        ):
+            raise ValueError(
+                f"type {target} already registered under an active code",
+            )
+        if legacy_codes:
+            seen: set[str] = set()
+            for lc in legacy_codes:
+                core.check_code_valid(lc)
+                if (
+                    lc in code_to_type
+                    or lc in codeset
+                    or lc in seen
+                    or lc == code
+                ):
+                    raise ValueError(
+                        f"code {lc} already registered",
+                    )
+                seen.add(lc)
+        # registration is deferred: only tag the class and queue it, the
+        # registry flushes the queue in one batch on first access
+        target._fcode = code  # type: ignore[attr-defined]
+        target._fcode_legacy_codes = legacy_codes  # type: ignore[attr-defined]
+        append_pending((code, target, legacy_codes))
+        codeset.add(code)
+        if legacy_codes:
+            codeset.update(legacy_codes)
+        core._pending_decorator_types.add(target)
         return target
 
     return inner